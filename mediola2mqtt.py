@@ -8,19 +8,32 @@ import select
 import socket
 import time
 import json
-import yaml
-import requests
 import datetime
-import paho.mqtt.client as mqtt
 
 INTERVAL_REFRESH_AFTER_ACTION = 10
 AFTER_ACTION_DURATION = 30
 INTERVAL_BETWEEN_REFRESH = 60
+# Default button timings, can be overridden per button with repeat_timeout,
+# long_press_duration and multi_press_timeout
+# Button events closer than this belong to the same (held) press
+BUTTON_REPEAT_TIMEOUT = 0.15
+# A press held at least this long is reported as a long press
+BUTTON_LONG_PRESS_DURATION = 1.0
+# Window from the first press in which further presses count as multi press
+BUTTON_MULTI_PRESS_TIMEOUT = 0.9
 last_refresh = 0
 last_action = 0
 subscribed = []
+button_presses = {}
+button_triggers = set()
+config = None
+mqttc = None
 
 def call_mediola(payload, verbose=True):
+    # requests is only needed once we talk to the gateway, keep it out of the
+    # import path so that the module loads fast
+    import requests
+
     url = 'http://' + config['mediola']['host'] + '/command'
     i = 0
     sent = False
@@ -198,6 +211,110 @@ def publish_blind(blind):
     subscribed.append(topic + "/set")
     mqttc.publish(dtopic, payload=payload, retain=True)
 
+def publish_button_triggers(button, code):
+    identifier = button['type'] + '_' + button['addr']
+    topic = config['mqtt']['topic'] + '/buttons/' + identifier + '/action'
+
+    for action, trigger_type in [('single', 'button_short_press'),
+                                 ('double', 'button_double_press'),
+                                 ('triple', 'button_triple_press'),
+                                 ('long', 'button_long_press')]:
+        trigger_id = identifier + '_' + code + '_' + action
+        dtopic = config['mqtt']['discovery_prefix'] + '/device_automation/' + \
+                 trigger_id + '/config'
+        payload = {
+          "automation_type" : "trigger",
+          "topic" : topic,
+          "type" : trigger_type,
+          "subtype" : "button_" + code,
+          "payload" : code + '_' + action,
+          "device" : {
+            "identifiers" : identifier,
+            "manufacturer" : "Mediola",
+            "name" : "Button",
+          },
+        }
+        if 'name' in button:
+            payload["device"]["suggested_area"] = button['name']
+        payload = json.dumps(payload)
+        mqttc.publish(dtopic, payload=payload, retain=True)
+
+def publish_button_action(button, code, action):
+    identifier = button['type'] + '_' + button['addr']
+    topic = config['mqtt']['topic'] + '/buttons/' + identifier + '/action'
+    payload = code + '_' + action
+    print_log('Publishing to %s: %s' % (topic, payload))
+    mqttc.publish(topic, payload=payload, retain=False)
+
+def button_event(button, code, now):
+    # Aggregate the raw events of a button into single, double, triple and
+    # long presses. Remotes keep sending while a button is held, so events
+    # less than repeat_timeout apart belong to the same press and a larger
+    # gap starts a new press.
+    flush_button_presses(now)
+
+    key = (button['type'] + '_' + button['addr'], code)
+    if key not in button_triggers:
+        publish_button_triggers(button, code)
+        button_triggers.add(key)
+
+    repeat_timeout = button.get('repeat_timeout', BUTTON_REPEAT_TIMEOUT)
+    long_press_duration = button.get('long_press_duration',
+                                     BUTTON_LONG_PRESS_DURATION)
+
+    state = button_presses.get(key)
+    if state and now - state['last'] < repeat_timeout:
+        state['last'] = now
+        if not state['long'] and now - state['press'] >= long_press_duration:
+            # Presses before the long one are reported on their own, so a
+            # tap followed by a hold gives a single and then a long press
+            if state['count'] > 1:
+                publish_button_presses(button, code, state['count'] - 1)
+            publish_button_action(button, code, 'long')
+            state['long'] = True
+        return
+
+    # A new press after a long one starts a new sequence
+    if not state or state['long']:
+        state = {'button': button, 'count': 0, 'long': False, 'start': now}
+        button_presses[key] = state
+    state['press'] = now
+    state['last'] = now
+    state['count'] += 1
+
+def publish_button_presses(button, code, count):
+    actions = {1: 'single', 2: 'double', 3: 'triple'}
+    if count not in actions:
+        print_log('Ignoring %d presses of %s_%s' % (count, button['type'],
+                                                     button['addr']))
+        return
+    publish_button_action(button, code, actions[count])
+
+def flush_button_presses(now):
+    # Report the press sequences whose multi press window is over and whose
+    # button has been released, and return the time until the next one is
+    # due, if any
+    timeout = None
+    for key, state in list(button_presses.items()):
+        button = state['button']
+        due = state['last'] + button.get('repeat_timeout', BUTTON_REPEAT_TIMEOUT)
+        if not state['long']:
+            due = max(due, state['start'] + button.get('multi_press_timeout',
+                                                       BUTTON_MULTI_PRESS_TIMEOUT))
+        remaining = due - now
+        if remaining > 0:
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+            continue
+
+        del button_presses[key]
+        # A long press has already been reported while the button was held
+        if state['long']:
+            continue
+        publish_button_presses(button, key[1], state['count'])
+
+    return timeout
+
 def get_states():
     payload = {
         "XC_FNC" : "GetStates",
@@ -211,106 +328,74 @@ def get_states():
 
     return response.content[len(header):]
 
-config_files = [
-#        ['/data/options.json', 'Running in hass.io add-on mode'],
-        ['/config/mediola2mqtt.yaml', 'Running in legacy add-on mode'],
-        ['mediola2mqtt.yaml', 'Running in local mode'],
-    ]
-config = None
+def load_config():
+    config_files = [
+#            ['/data/options.json', 'Running in hass.io add-on mode'],
+            ['/config/mediola2mqtt.yaml', 'Running in legacy add-on mode'],
+            ['mediola2mqtt.yaml', 'Running in local mode'],
+        ]
 
-for config_file, comment in config_files:
-    if not os.path.isfile(config_file):
-        continue
-    print_log(comment)
-    with open(config_file, 'r') as fp:
-        if config_file.endswith('.json'):
-            config = json.load(fp)
-            break
-        if config_file.endswith('.yaml'):
-            config = yaml.safe_load(fp)
-            break
-    break
+    for config_file, comment in config_files:
+        if not os.path.isfile(config_file):
+            continue
+        print_log(comment)
+        with open(config_file, 'r') as fp:
+            if config_file.endswith('.json'):
+                return json.load(fp)
+            if config_file.endswith('.yaml'):
+                import yaml
+                return yaml.safe_load(fp)
+        break
 
-if not config:
-    print_log('Configuration file not found, exiting.')
-    sys.exit(1)
+    return None
 
-# Setup MQTT connection
-mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+def setup_mqtt():
+    import paho.mqtt.client as mqtt
 
-mqttc.on_connect = on_connect
-mqttc.on_subscribe = on_subscribe
-mqttc.on_disconnect = on_disconnect
-mqttc.on_message = on_message
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 
-if config['mqtt']['debug']:
-    print_log("Debugging messages enabled")
-    mqttc.on_log = on_log
-    mqttc.on_publish = on_publish
+    client.on_connect = on_connect
+    client.on_subscribe = on_subscribe
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
 
-if config['mqtt']['username'] and config['mqtt']['password']:
-    mqttc.username_pw_set(config['mqtt']['username'], config['mqtt']['password'])
-try:
-    mqttc.connect(config['mqtt']['host'], config['mqtt']['port'], 60)
-except:
-    print_log('Error connecting to MQTT, will now quit.')
-    sys.exit(1)
-mqttc.loop_start()
+    if config['mqtt']['debug']:
+        print_log("Debugging messages enabled")
+        client.on_log = on_log
+        client.on_publish = on_publish
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind(('', config['mediola']['udp_port']))
+    if config['mqtt']['username'] and config['mqtt']['password']:
+        client.username_pw_set(config['mqtt']['username'], config['mqtt']['password'])
+    try:
+        client.connect(config['mqtt']['host'], config['mqtt']['port'], 60)
+    except:
+        print_log('Error connecting to MQTT, will now quit.')
+        sys.exit(1)
+    client.loop_start()
 
-# Set up discovery structure
+    return client
 
-if 'buttons' in config:
-    # Buttons are configured as MQTT device triggers
-    for button in config['buttons']:
-        payload = publish_button(button)
+def publish_discovery():
+    if 'buttons' in config:
+        # Buttons are configured as MQTT device triggers
+        for button in config['buttons']:
+            publish_button(button)
 
-if 'blinds' in config:
-    for blind in config['blinds']:
-        payload = publish_blind(blind)
+    if 'blinds' in config:
+        for blind in config['blinds']:
+            publish_blind(blind)
 
-        # ER blinds have double tap up and down which tell the blind to go to
-        # preset settings. So we create two buttons for these
-        if blind['type'] != 'ER':
-            continue
-        publish_button(blind, sub_identifier='doubleup', sub_name='double up')
-        publish_button(blind, sub_identifier='doubledown', sub_name='double down')
-
-while True:
-    readable, _, _ = select.select([sock], [], [], 1)
-    if not readable:
-        curtime = time.time()
-        if curtime - last_refresh >= INTERVAL_BETWEEN_REFRESH:
-            print_log('Refreshing after refresh timeout')
-            last_refresh = time.time()
-        elif last_action > 0:
-            if curtime - last_action < INTERVAL_REFRESH_AFTER_ACTION:
+            # ER blinds have double tap up and down which tell the blind to go to
+            # preset settings. So we create two buttons for these
+            if blind['type'] != 'ER':
                 continue
-            print_log('Refreshing after action')
-            if curtime - last_action >= AFTER_ACTION_DURATION:
-                last_action = 0
-        else:
-            continue
-
-        data = get_states()
-        refresh = True
-        ip = port = 'N/A'
-        if config['mqtt']['debug']:
-            print_log(f'Got states: {data}')
-    else:
-        refresh = False
-        if sock not in readable:
-            continue
-        data, (ip, port) = sock.recvfrom(1024)
+            publish_button(blind, sub_identifier='doubleup', sub_name='double up')
+            publish_button(blind, sub_identifier='doubledown', sub_name='double down')
 
-        header = b'{XC_EVT}'
-        if not data.startswith(header):
-            print_log(f'Received something else than an event: {data}')
-            continue
-
-        data = data[len(header):]
+def handle_data(data, refresh=False, ip='N/A', port='N/A', now=None):
+    # now is the time.monotonic() timestamp of the data, used for button presses
+    if now is None:
+        now = time.monotonic()
 
     if config['mqtt']['debug']:
         print_log('Received message from %s:%d : %s' % (ip, port, data))
@@ -320,7 +405,7 @@ while True:
         all_data = json.loads(data)
     except ValueError as e:
         print_log("Couldn't load text as JSON: ", e)
-        continue
+        return
 
     if isinstance(all_data, dict):
         all_data = [all_data]
@@ -354,9 +439,16 @@ while True:
             elif data_dict[key][0:-2].lower() != button['addr'].lower():
                 continue
 
+            payload = data_dict[key][-2:]
+            if button.get('aggregate', False):
+                # States from a refresh are not button presses
+                if not refresh:
+                    button_event(button, payload.lower(), now)
+                found = True
+                break
+
             identifier = button['type'] + '_' + button['addr']
             topic = config['mqtt']['topic'] + '/buttons/' + identifier
-            payload = data_dict[key][-2:]
             print_log('%sing to %s: %s' % ('Refresh' if refresh else 'Publish', topic, payload))
             mqttc.publish(topic, payload=payload, retain=False)
             found = True
@@ -431,3 +523,66 @@ while True:
                                                                     data_dict))
         else:
             print_log('Received unknown state: %s' % data_dict)
+
+def main():
+    global config, mqttc, last_refresh, last_action
+
+    config = load_config()
+    if not config:
+        print_log('Configuration file not found, exiting.')
+        sys.exit(1)
+
+    # Setup MQTT connection
+    mqttc = setup_mqtt()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', config['mediola']['udp_port']))
+
+    # Set up discovery structure
+    publish_discovery()
+
+    while True:
+        timeout = flush_button_presses(time.monotonic())
+        if timeout is None or timeout > 1:
+            timeout = 1
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if not readable:
+            curtime = time.time()
+            if curtime - last_refresh >= INTERVAL_BETWEEN_REFRESH:
+                print_log('Refreshing after refresh timeout')
+                last_refresh = time.time()
+            elif last_action > 0:
+                if curtime - last_action < INTERVAL_REFRESH_AFTER_ACTION:
+                    continue
+                print_log('Refreshing after action')
+                if curtime - last_action >= AFTER_ACTION_DURATION:
+                    last_action = 0
+            else:
+                continue
+
+            data = get_states()
+            refresh = True
+            ip = port = 'N/A'
+            now = time.monotonic()
+            if config['mqtt']['debug']:
+                print_log(f'Got states: {data}')
+        else:
+            refresh = False
+            if sock not in readable:
+                continue
+            data, (ip, port) = sock.recvfrom(1024)
+            # Button presses are timed with the monotonic clock, so that
+            # the wall clock being stepped does not break them
+            now = time.monotonic()
+
+            header = b'{XC_EVT}'
+            if not data.startswith(header):
+                print_log(f'Received something else than an event: {data}')
+                continue
+
+            data = data[len(header):]
+
+        handle_data(data, refresh, ip, port, now)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import json
+
+import mediola2mqtt
+
+
+class FakeClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, retain=False):
+        self.published.append((topic, payload))
+
+
+BUTTON = {'type': 'IT', 'addr': '3d5e00', 'aggregate': True}
+
+
+def setup_function(function):
+    mediola2mqtt.config = {
+        'mqtt': {'topic': 'mediola', 'discovery_prefix': 'homeassistant',
+                 'debug': False},
+        'buttons': [BUTTON],
+        'blinds': [],
+    }
+    mediola2mqtt.mqttc = FakeClient()
+    mediola2mqtt.button_presses.clear()
+    mediola2mqtt.button_triggers.clear()
+
+
+def actions():
+    return [payload for topic, payload in mediola2mqtt.mqttc.published
+            if topic == 'mediola/buttons/IT_3d5e00/action']
+
+
+def press(start, duration=0.05, code='01'):
+    # The gateway forwards a burst of frames as long as the button is held
+    for i in range(round(duration / 0.05) + 1):
+        mediola2mqtt.button_event(BUTTON, code, start + i * 0.05)
+
+
+def test_single():
+    press(0)
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == ['01_single']
+
+
+def test_double():
+    press(0)
+    press(0.25)
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == ['01_double']
+
+
+def test_slow_presses_are_singles():
+    press(0)
+    press(1.5)
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == ['01_single', '01_single']
+
+
+def test_triple():
+    press(0)
+    press(0.3)
+    press(0.6)
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == ['01_triple']
+
+
+def test_more_than_three_presses_are_ignored():
+    for i in range(4):
+        press(i * 0.2)
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == []
+
+
+def test_long():
+    press(0, duration=1.2)
+    assert actions() == ['01_long']
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == ['01_long']
+
+
+def test_long_then_tap():
+    press(0, duration=1.2)
+    press(1.6)
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == ['01_long', '01_single']
+
+
+def test_tap_then_long():
+    press(0)
+    press(0.3, duration=1.2)
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == ['01_single', '01_long']
+
+
+def test_flush_waits_for_release():
+    # The press ends at 0.85 s, after the 0.9 s multi press window is over
+    # the release window (0.85 + 0.15 s) is still open
+    press(0, duration=0.85)
+    assert mediola2mqtt.flush_button_presses(0.95) > 0
+    assert actions() == []
+    mediola2mqtt.flush_button_presses(1.1)
+    assert actions() == ['01_single']
+
+
+def test_button_timings():
+    button = dict(BUTTON, repeat_timeout=0.3, long_press_duration=2.0)
+    for i in range(7):
+        mediola2mqtt.button_event(button, '01', i * 0.25)
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == ['01_single']
+
+
+def test_triggers_are_announced_once():
+    press(0)
+    press(2)
+    topics = [topic for topic, payload in mediola2mqtt.mqttc.published
+              if topic.startswith('homeassistant/device_automation/')]
+    assert len(topics) == 4
+    trigger = json.loads(dict(mediola2mqtt.mqttc.published)[
+        'homeassistant/device_automation/IT_3d5e00_01_double/config'])
+    assert trigger['type'] == 'button_double_press'
+    assert trigger['payload'] == '01_double'
+
+
+def test_refresh_is_not_a_press():
+    data = json.dumps({'type': 'IT', 'data': '3D5E0001'})
+    mediola2mqtt.handle_data(data, refresh=True)
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == []
+    assert mediola2mqtt.button_presses == {}
+
+
+def test_event_timestamp_is_used():
+    data = json.dumps({'type': 'IT', 'data': '3D5E0001'})
+    mediola2mqtt.handle_data(data, ip='192.168.1.2', port=1902, now=0)
+    mediola2mqtt.handle_data(data, ip='192.168.1.2', port=1902, now=0.25)
+    mediola2mqtt.flush_button_presses(5)
+    assert actions() == ['01_double']
+
+
+def test_raw_events_without_aggregation():
+    mediola2mqtt.config['buttons'] = [{'type': 'IT', 'addr': '3d5e00'}]
+    data = json.dumps({'type': 'IT', 'data': '3D5E0001'})
+    mediola2mqtt.handle_data(data, ip='192.168.1.2', port=1902)
+    assert mediola2mqtt.mqttc.published == [('mediola/buttons/IT_3d5e00', '01')]